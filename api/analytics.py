@@ -0,0 +1,197 @@
+"""
+Rollups de vendas por minuto, hora e dia.
+
+create_purchase chama record_sale() na mesma transação da compra, então as
+consultas de série temporal leem poucas linhas de sales_rollups em vez de
+varrer purchases e raffle_numbers. Compras e receita são histórico; numbers_sold
+conta os números ainda ligados à compra, então reset-numbers desconta os números
+apagados (unrecord_numbers), o mesmo resultado que backfill() produz.
+
+Para dados anteriores aos rollups (com as escritas da API paradas):
+
+    python -m api.analytics backfill
+"""
+
+import sys
+from collections import defaultdict
+from datetime import datetime, timedelta
+from enum import Enum
+from typing import Optional
+from sqlalchemy import select, func, delete, insert, update
+from sqlalchemy.orm import Session
+from .models import Purchase, RaffleNumber, SalesRollup
+
+class Granularity(str, Enum):
+    minute = "minute"
+    hour = "hour"
+    day = "day"
+
+
+# Janela padrão de consulta quando start não é informado
+DEFAULT_WINDOWS = {
+    Granularity.minute: timedelta(hours=1),
+    Granularity.hour: timedelta(days=7),
+    Granularity.day: timedelta(days=30),
+}
+
+
+def bucket_start(ts: datetime, granularity: Granularity) -> datetime:
+    if granularity is Granularity.minute:
+        return ts.replace(second=0, microsecond=0)
+    if granularity is Granularity.hour:
+        return ts.replace(minute=0, second=0, microsecond=0)
+    return ts.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def _upsert_statement(dialect: str, values: dict):
+    # Só SQLite e Postgres são suportados (ver database.py); ambos têm ON CONFLICT
+    if dialect == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert
+    elif dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert as dialect_insert
+    else:
+        raise RuntimeError(f"rollups de vendas nao suportam o banco {dialect}")
+    table = SalesRollup.__table__
+    stmt = dialect_insert(table).values(**values)
+    return stmt.on_conflict_do_update(
+        index_elements=[table.c.granularity, table.c.raffle_id, table.c.bucket_start],
+        set_={
+            "purchases": table.c.purchases + stmt.excluded.purchases,
+            "numbers_sold": table.c.numbers_sold + stmt.excluded.numbers_sold,
+            "revenue": table.c.revenue + stmt.excluded.revenue,
+        },
+    )
+
+
+def record_sale(db: Session, raffle_id: str, numbers_sold: int, revenue: float, at: datetime) -> None:
+    """Soma uma compra aos rollups de cada granularidade (sem commit)."""
+    dialect = db.get_bind().dialect.name
+    for granularity in Granularity:
+        values = {
+            "granularity": granularity.value,
+            "raffle_id": raffle_id,
+            "bucket_start": bucket_start(at, granularity),
+            "purchases": 1,
+            "numbers_sold": numbers_sold,
+            "revenue": revenue,
+        }
+        db.execute(_upsert_statement(dialect, values))
+
+
+def unrecord_numbers(db: Session, raffle_id: str) -> None:
+    """Desconta dos rollups os números vendidos da rifa antes de apagá-los (sem commit)."""
+    rows = db.execute(
+        select(Purchase.created_at, func.count(RaffleNumber.id))
+        .join(RaffleNumber, RaffleNumber.purchase_id == Purchase.id)
+        .where(RaffleNumber.raffle_id == raffle_id)
+        .group_by(Purchase.id, Purchase.created_at)
+    ).all()
+    removed: dict[tuple[Granularity, datetime], int] = defaultdict(int)
+    for created_at, numbers_sold in rows:
+        for granularity in Granularity:
+            removed[(granularity, bucket_start(created_at, granularity))] += numbers_sold
+    for (granularity, start), numbers_sold in removed.items():
+        db.execute(
+            update(SalesRollup)
+            .where(
+                SalesRollup.granularity == granularity.value,
+                SalesRollup.raffle_id == raffle_id,
+                SalesRollup.bucket_start == start,
+            )
+            .values(numbers_sold=SalesRollup.numbers_sold - numbers_sold)
+        )
+
+
+def query_sales(
+    db: Session,
+    granularity: Granularity,
+    start: datetime,
+    end: datetime,
+    raffle_id: Optional[str] = None,
+) -> list[dict]:
+    """Série temporal [start, end) por rifa, ou global quando raffle_id é None."""
+    query = (
+        select(
+            SalesRollup.bucket_start,
+            func.sum(SalesRollup.purchases),
+            func.sum(SalesRollup.numbers_sold),
+            func.sum(SalesRollup.revenue),
+        )
+        .where(
+            SalesRollup.granularity == granularity.value,
+            SalesRollup.bucket_start >= bucket_start(start, granularity),
+            SalesRollup.bucket_start < end,
+        )
+        .group_by(SalesRollup.bucket_start)
+        .order_by(SalesRollup.bucket_start)
+    )
+    if raffle_id:
+        query = query.where(SalesRollup.raffle_id == raffle_id)
+    return [
+        {
+            "bucket_start": bucket.isoformat(),
+            "purchases": int(purchases),
+            "numbers_sold": int(numbers_sold),
+            "revenue": float(revenue),
+        }
+        for bucket, purchases, numbers_sold, revenue in db.execute(query).all()
+    ]
+
+
+def backfill(db: Session) -> int:
+    """
+    Recria todos os rollups a partir de purchases e raffle_numbers. Retorna o
+    número de linhas. Apaga e reinsere tudo: rode com as escritas da API paradas,
+    senão compras concorrentes podem ficar fora dos rollups.
+    """
+    numbers_per_purchase = (
+        select(RaffleNumber.purchase_id, func.count().label("numbers_sold"))
+        .where(RaffleNumber.purchase_id.is_not(None))
+        .group_by(RaffleNumber.purchase_id)
+        .subquery()
+    )
+    rows = db.execute(
+        select(
+            Purchase.raffle_id,
+            Purchase.created_at,
+            Purchase.total_amount,
+            func.coalesce(numbers_per_purchase.c.numbers_sold, 0),
+        ).outerjoin(numbers_per_purchase, numbers_per_purchase.c.purchase_id == Purchase.id)
+    ).all()
+    buckets: dict[tuple[Granularity, str, datetime], list] = {}
+    for raffle_id, created_at, total_amount, numbers_sold in rows:
+        for granularity in Granularity:
+            key = (granularity, raffle_id, bucket_start(created_at, granularity))
+            acc = buckets.setdefault(key, [0, 0, 0.0])
+            acc[0] += 1
+            acc[1] += numbers_sold
+            acc[2] += total_amount
+    db.execute(delete(SalesRollup))
+    if buckets:
+        db.execute(
+            insert(SalesRollup),
+            [
+                {
+                    "granularity": granularity.value,
+                    "raffle_id": raffle_id,
+                    "bucket_start": start,
+                    "purchases": purchases,
+                    "numbers_sold": numbers_sold,
+                    "revenue": revenue,
+                }
+                for (granularity, raffle_id, start), (purchases, numbers_sold, revenue) in buckets.items()
+            ],
+        )
+    db.commit()
+    return len(buckets)
+
+
+if __name__ == "__main__":
+    from .database import Base, SessionLocal, engine
+
+    if sys.argv[1:] != ["backfill"]:
+        print("uso: python -m api.analytics backfill")
+        sys.exit(2)
+    Base.metadata.create_all(bind=engine)
+    with SessionLocal() as session:
+        print(f"{backfill(session)} linhas de rollup geradas")
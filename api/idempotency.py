@@ -0,0 +1,155 @@
+"""
+Chaves de idempotência (header Idempotency-Key) para POST /api/purchase.
+
+O resultado da primeira execução fica guardado por IDEMPOTENCY_TTL_SECONDS e é
+reenviado nas repetições do mesmo escopo (webhook, usuário autenticado ou,
+sem autenticação, só a própria chave). Duplicatas concorrentes aguardam
+a requisição em andamento em vez de ir ao banco. O armazenamento é em memória,
+por processo, limitado a IDEMPOTENCY_MAX_KEYS chaves.
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Optional
+from fastapi import HTTPException, Request
+from .security import is_webhook_caller, request_user_id
+
+IDEMPOTENCY_TTL_SECONDS = int(os.getenv("IDEMPOTENCY_TTL_SECONDS", "86400"))
+IDEMPOTENCY_MAX_KEYS = int(os.getenv("IDEMPOTENCY_MAX_KEYS", "10000"))
+# Quanto uma duplicata espera pela requisição em andamento antes de receber 409
+IDEMPOTENCY_WAIT_SECONDS = float(os.getenv("IDEMPOTENCY_WAIT_SECONDS", "30"))
+IDEMPOTENCY_RETRY_AFTER = 1
+IDEMPOTENCY_KEY_MAX_LENGTH = 255
+
+
+@dataclass
+class StoredResponse:
+    status_code: int
+    body: Any
+
+
+@dataclass
+class _Entry:
+    fingerprint: str
+    expires_at: float
+    done: asyncio.Event = field(default_factory=asyncio.Event)
+    response: Optional[StoredResponse] = None
+
+
+def request_fingerprint(payload: dict) -> str:
+    """Hash estável do corpo da requisição, para detectar reuso da chave com outro payload."""
+    raw = json.dumps(payload, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def idempotency_scope(request: Request) -> str:
+    """
+    Escopo da chave. Chamadores anônimos não usam o IP, que muda entre
+    tentativas (wifi/4G, webhooks em serverless); o fingerprint do payload já
+    impede reusar a chave com outros dados.
+    """
+    if is_webhook_caller(request):
+        return "webhook"
+    user_id = request_user_id(request)
+    if user_id:
+        return f"user:{user_id}"
+    return "anonymous"
+
+
+class IdempotencyStore:
+    def __init__(
+        self,
+        ttl_seconds: int = IDEMPOTENCY_TTL_SECONDS,
+        max_entries: int = IDEMPOTENCY_MAX_KEYS,
+        wait_seconds: float = IDEMPOTENCY_WAIT_SECONDS,
+    ):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.wait_seconds = wait_seconds
+        # Chave = (escopo, Idempotency-Key); ver idempotency_scope().
+        # TTL fixo: a ordem de inserção é também a ordem de expiração
+        self._entries: "OrderedDict[tuple[str, str], _Entry]" = OrderedDict()
+
+    def _purge_expired(self, now: float) -> None:
+        # Chaves em andamento são puladas, sem impedir a expiração das seguintes
+        expired = []
+        for key, entry in self._entries.items():
+            if entry.response is None:
+                continue
+            if entry.expires_at > now:
+                break
+            expired.append(key)
+        for key in expired:
+            del self._entries[key]
+
+    def _evict_overflow(self) -> None:
+        # Descarta as respostas concluídas mais antigas; chaves em andamento nunca saem
+        excess = len(self._entries) - self.max_entries
+        if excess <= 0:
+            return
+        victims = []
+        for key, entry in self._entries.items():
+            if entry.response is not None:
+                victims.append(key)
+                if len(victims) == excess:
+                    break
+        for key in victims:
+            del self._entries[key]
+
+    async def begin(self, caller: str, key: str, fingerprint: str) -> Optional[StoredResponse]:
+        """
+        Retorna a resposta armazenada para a chave, aguardando se ela estiver em
+        andamento. Retorna None quando o chamador passa a ser o dono da chave e
+        deve executar a operação e depois chamar complete() ou release().
+        """
+        if len(key) > IDEMPOTENCY_KEY_MAX_LENGTH:
+            raise HTTPException(status_code=400, detail="Idempotency-Key muito longa")
+        scoped = (caller, key)
+        while True:
+            now = time.monotonic()
+            self._purge_expired(now)
+            entry = self._entries.get(scoped)
+            if entry is None or (entry.response is not None and entry.expires_at <= now):
+                self._entries.pop(scoped, None)
+                self._entries[scoped] = _Entry(fingerprint=fingerprint, expires_at=now + self.ttl_seconds)
+                self._evict_overflow()
+                return None
+            if entry.fingerprint != fingerprint:
+                raise HTTPException(
+                    status_code=422,
+                    detail="Idempotency-Key ja utilizada com outros dados",
+                )
+            if entry.response is not None:
+                return entry.response
+            try:
+                await asyncio.wait_for(entry.done.wait(), timeout=self.wait_seconds)
+            except asyncio.TimeoutError:
+                raise HTTPException(
+                    status_code=409,
+                    detail="Requisicao com esta Idempotency-Key ainda em andamento",
+                    headers={"Retry-After": str(IDEMPOTENCY_RETRY_AFTER)},
+                )
+            # Se o dono liberou a chave sem resultado, tentamos assumir a chave
+
+    def complete(self, caller: str, key: str, status_code: int, body: Any) -> None:
+        entry = self._entries.get((caller, key))
+        if entry is None:
+            return
+        entry.response = StoredResponse(status_code=status_code, body=body)
+        entry.expires_at = time.monotonic() + self.ttl_seconds
+        self._entries.move_to_end((caller, key))
+        entry.done.set()
+
+    def release(self, caller: str, key: str) -> None:
+        """Descarta a chave (falha inesperada) para que uma nova tentativa execute de novo."""
+        entry = self._entries.pop((caller, key), None)
+        if entry is not None:
+            entry.done.set()
+
+
+idempotency_store = IdempotencyStore()
@@ -4,22 +4,32 @@ Backend API com FastAPI e Python
 """
 
 import os
+import logging
 from pathlib import Path
-from fastapi import FastAPI, HTTPException, Depends, UploadFile, File, Request
+from fastapi import FastAPI, HTTPException, Depends, UploadFile, File, Request, Response, Header
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse
 from pydantic import BaseModel, EmailStr
 from typing import Optional
-from datetime import datetime
+from datetime import datetime, timezone
 from enum import Enum
 import uuid
 import random
 from sqlalchemy.orm import Session
 from sqlalchemy import select, func, and_, delete
-from .database import Base, engine, get_db
-from .models import Raffle, RaffleNumber, Purchase, User
-from .security import hash_password, verify_password, create_access_token, get_current_user
+from .database import (
+    Base, engine, SessionLocal, get_db, get_read_db, db_admission, read_your_writes_token, READ_YOUR_WRITES_HEADER,
+)
+from .models import Raffle, RaffleNumber, Purchase, User, SalesRollup
+from .security import hash_password, verify_password, create_access_token, get_current_user, WEBHOOK_SECRET
+from .idempotency import idempotency_store, idempotency_scope, request_fingerprint
+from .analytics import Granularity, DEFAULT_WINDOWS, record_sale, unrecord_numbers, query_sales
+from .ratelimit import rate_limit, enforce_rate_limit
 from fastapi.staticfiles import StaticFiles
 
+logger = logging.getLogger(__name__)
+
 app = FastAPI(
     title="Rifa Aí API",
     description="API para sistema de rifas online",
@@ -34,6 +44,8 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    # Permite ao front ler o token de read-your-writes devolvido pela compra
+    expose_headers=[READ_YOUR_WRITES_HEADER],
 )
 
 # Static files for uploaded images
@@ -151,6 +163,11 @@ def on_startup():
     # Create tables
     Base.metadata.create_all(bind=engine)
     # Sem seeds: base limpa para receber novos dados
+    if not WEBHOOK_SECRET:
+        logger.warning(
+            "WEBHOOK_SECRET nao definido: compras confirmadas pelo webhook do Stripe "
+            "passam pelo limite de requisicoes do IP do webhook"
+        )
 
 
 # Routes
@@ -165,7 +182,7 @@ async def health_check():
 
 # Auth Routes
 @app.post("/api/auth/register", response_model=UserResponse)
-async def register_user(payload: UserRegister, db: Session = Depends(get_db)):
+def register_user(payload: UserRegister, db: Session = Depends(get_db)):
     # Verificar unicidade de username, email e cpf
     exists = db.execute(
         select(User).where(
@@ -203,7 +220,7 @@ class LoginPayload(BaseModel):
     password: str
 
 @app.post("/api/auth/login", response_model=TokenResponse)
-async def login(payload: LoginPayload, db: Session = Depends(get_db)):
+def login(payload: LoginPayload, db: Session = Depends(get_db)):
     user = db.execute(select(User).where(User.username == payload.username)).scalars().first()
     if not user or not verify_password(payload.password, user.password_hash):
         raise HTTPException(status_code=401, detail="Credenciais inválidas")
@@ -254,8 +271,12 @@ async def upload_image(request: Request, file: UploadFile = File(...)):
 
 
 # Raffle Routes
-@app.get("/api/raffles", response_model=list[RaffleResponse])
-async def get_raffles(status: Optional[RaffleStatus] = None, db: Session = Depends(get_db)):
+@app.get(
+    "/api/raffles",
+    response_model=list[RaffleResponse],
+    dependencies=[Depends(rate_limit("read"))],
+)
+def get_raffles(status: Optional[RaffleStatus] = None, db: Session = Depends(get_read_db)):
     """Listar todas as rifas"""
     query = select(Raffle)
     if status:
@@ -279,8 +300,12 @@ async def get_raffles(status: Optional[RaffleStatus] = None, db: Session = Depen
     ]
 
 
-@app.get("/api/raffles/{raffle_id}", response_model=RaffleResponse)
-async def get_raffle(raffle_id: str, db: Session = Depends(get_db)):
+@app.get(
+    "/api/raffles/{raffle_id}",
+    response_model=RaffleResponse,
+    dependencies=[Depends(rate_limit("read"))],
+)
+def get_raffle(raffle_id: str, db: Session = Depends(get_read_db)):
     """Obter detalhes de uma rifa"""
     r = db.get(Raffle, raffle_id)
     if not r:
@@ -301,7 +326,7 @@ async def get_raffle(raffle_id: str, db: Session = Depends(get_db)):
 
 
 @app.post("/api/raffles", response_model=RaffleResponse)
-async def create_raffle(raffle: RaffleCreate, db: Session = Depends(get_db)):
+def create_raffle(raffle: RaffleCreate, db: Session = Depends(get_db)):
     """Criar uma nova rifa"""
     raffle_id = str(uuid.uuid4())
     r = Raffle(
@@ -335,7 +360,7 @@ async def create_raffle(raffle: RaffleCreate, db: Session = Depends(get_db)):
 
 
 @app.put("/api/raffles/{raffle_id}", response_model=RaffleResponse)
-async def update_raffle(raffle_id: str, raffle: RaffleCreate, db: Session = Depends(get_db)):
+def update_raffle(raffle_id: str, raffle: RaffleCreate, db: Session = Depends(get_db)):
     """Atualizar uma rifa"""
     r = db.get(Raffle, raffle_id)
     if not r:
@@ -365,19 +390,24 @@ async def update_raffle(raffle_id: str, raffle: RaffleCreate, db: Session = Depe
 
 
 @app.delete("/api/raffles/{raffle_id}")
-async def delete_raffle(raffle_id: str, db: Session = Depends(get_db)):
+def delete_raffle(raffle_id: str, db: Session = Depends(get_db)):
     """Excluir uma rifa"""
     r = db.get(Raffle, raffle_id)
     if not r:
         raise HTTPException(status_code=404, detail="Rifa nao encontrada")
+    db.execute(delete(SalesRollup).where(SalesRollup.raffle_id == raffle_id))
     db.delete(r)
     db.commit()
     return {"message": "Rifa excluida com sucesso"}
 
 
 # Numbers Routes
-@app.get("/api/raffles/{raffle_id}/numbers", response_model=list[RaffleNumberResponse])
-async def get_raffle_numbers(raffle_id: str, db: Session = Depends(get_db)):
+@app.get(
+    "/api/raffles/{raffle_id}/numbers",
+    response_model=list[RaffleNumberResponse],
+    dependencies=[Depends(rate_limit("grid"))],
+)
+def get_raffle_numbers(raffle_id: str, db: Session = Depends(get_read_db)):
     """Obter numeros de uma rifa"""
     r = db.get(Raffle, raffle_id)
     if not r:
@@ -400,8 +430,11 @@ async def get_raffle_numbers(raffle_id: str, db: Session = Depends(get_db)):
     ]
 
 
-@app.get("/api/raffles/{raffle_id}/stats")
-async def get_raffle_stats(raffle_id: str, db: Session = Depends(get_db)):
+@app.get(
+    "/api/raffles/{raffle_id}/stats",
+    dependencies=[Depends(rate_limit("read"))],
+)
+def get_raffle_stats(raffle_id: str, db: Session = Depends(get_read_db)):
     """Obter estatisticas de uma rifa"""
     r = db.get(Raffle, raffle_id)
     if not r:
@@ -430,8 +463,61 @@ async def get_raffle_stats(raffle_id: str, db: Session = Depends(get_db)):
 
 # Purchase Routes
 @app.post("/api/purchase", response_model=PurchaseResponse)
-async def create_purchase(purchase: PurchaseCreate, db: Session = Depends(get_db)):
+async def create_purchase(
+    purchase: PurchaseCreate,
+    request: Request,
+    response: Response,
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"),
+):
     """Realizar uma compra de numeros"""
+    if not idempotency_key:
+        enforce_rate_limit("purchase", request)
+        result = await run_in_threadpool(_create_purchase_in_session, purchase)
+        _attach_read_your_writes(response)
+        return result
+    caller = idempotency_scope(request)
+    stored = await idempotency_store.begin(caller, idempotency_key, request_fingerprint(purchase.model_dump(mode="json")))
+    if stored is not None:
+        # Repetição da mesma chave: reenvia o resultado original sem gastar o limite
+        return JSONResponse(
+            status_code=stored.status_code,
+            content=stored.body,
+            headers={"Idempotent-Replayed": "true"},
+        )
+    completed = False
+    try:
+        enforce_rate_limit("purchase", request)
+        result = await run_in_threadpool(_create_purchase_in_session, purchase)
+        idempotency_store.complete(caller, idempotency_key, 200, result)
+        completed = True
+    except HTTPException as exc:
+        # 429/503 são transitórios: a repetição deve executar de novo
+        if exc.status_code < 500 and exc.status_code != 429:
+            idempotency_store.complete(caller, idempotency_key, exc.status_code, {"detail": exc.detail})
+            completed = True
+        raise
+    finally:
+        # Qualquer outra saída (erro, 429/503, cancelamento) libera a chave
+        if not completed:
+            idempotency_store.release(caller, idempotency_key)
+    _attach_read_your_writes(response)
+    return result
+
+
+def _attach_read_your_writes(response: Response) -> None:
+    # Quem reenviar este header nas leituras lê do primário por alguns segundos
+    token = read_your_writes_token()
+    if token is not None:
+        response.headers[READ_YOUR_WRITES_HEADER] = token
+
+
+def _create_purchase_in_session(purchase: PurchaseCreate) -> dict:
+    # A sessão só é aberta aqui, então duplicatas aguardando a chave não ocupam o banco
+    with db_admission(), SessionLocal() as db:
+        return _create_purchase(purchase, db)
+
+
+def _create_purchase(purchase: PurchaseCreate, db: Session) -> dict:
     r = db.get(Raffle, purchase.raffle_id)
     if not r:
         raise HTTPException(status_code=404, detail="Rifa nao encontrada")
@@ -472,6 +558,7 @@ async def create_purchase(purchase: PurchaseCreate, db: Session = Depends(get_db
             sold_at=now,
             purchase_id=purchase_id,
         ))
+    record_sale(db, purchase.raffle_id, len(purchase.numbers), total_amount, p.created_at)
     db.commit()
     return {
         "id": p.id,
@@ -487,7 +574,7 @@ async def create_purchase(purchase: PurchaseCreate, db: Session = Depends(get_db
 
 
 @app.get("/api/purchases", response_model=list[PurchaseResponse])
-async def get_purchases(raffle_id: Optional[str] = None, db: Session = Depends(get_db)):
+def get_purchases(raffle_id: Optional[str] = None, db: Session = Depends(get_read_db)):
     """Listar todas as compras"""
     query = select(Purchase)
     if raffle_id:
@@ -515,7 +602,7 @@ async def get_purchases(raffle_id: Optional[str] = None, db: Session = Depends(g
 
 # Draw Route
 @app.post("/api/raffles/{raffle_id}/draw", response_model=DrawResult)
-async def draw_raffle(raffle_id: str, db: Session = Depends(get_db)):
+def draw_raffle(raffle_id: str, db: Session = Depends(get_db)):
     """Realizar o sorteio de uma rifa"""
     r = db.get(Raffle, raffle_id)
     if not r:
@@ -543,7 +630,7 @@ async def draw_raffle(raffle_id: str, db: Session = Depends(get_db)):
 
 # Admin maintenance
 @app.post("/api/raffles/{raffle_id}/reset-numbers")
-async def reset_raffle_numbers(raffle_id: str, db: Session = Depends(get_db)):
+def reset_raffle_numbers(raffle_id: str, db: Session = Depends(get_db)):
     """Zera todos os números (reservados/vendidos) de uma rifa."""
     r = db.get(Raffle, raffle_id)
     if not r:
@@ -551,6 +638,7 @@ async def reset_raffle_numbers(raffle_id: str, db: Session = Depends(get_db)):
     count = db.execute(
         select(func.count()).select_from(RaffleNumber).where(RaffleNumber.raffle_id == raffle_id)
     ).scalar_one()
+    unrecord_numbers(db, raffle_id)
     db.execute(delete(RaffleNumber).where(RaffleNumber.raffle_id == raffle_id))
     r.status = "active"
     r.winner_number = None
@@ -560,21 +648,20 @@ async def reset_raffle_numbers(raffle_id: str, db: Session = Depends(get_db)):
 
 # Admin Stats
 @app.get("/api/admin/stats")
-async def get_admin_stats():
+def get_admin_stats(db: Session = Depends(get_read_db)):
     """Obter estatisticas gerais do sistema"""
-    with next(get_db()) as db:
-        total_raffles = db.execute(select(func.count()).select_from(Raffle)).scalar_one()
-        active_raffles = db.execute(
-            select(func.count()).select_from(Raffle).where(Raffle.status == "active")
-        ).scalar_one()
-        completed_raffles = db.execute(
-            select(func.count()).select_from(Raffle).where(Raffle.status == "completed")
-        ).scalar_one()
-        total_purchases = db.execute(select(func.count()).select_from(Purchase)).scalar_one()
-        total_revenue = db.execute(select(func.coalesce(func.sum(Purchase.total_amount), 0.0))).scalar_one()
-        total_numbers_sold = db.execute(
-            select(func.count()).select_from(RaffleNumber).where(RaffleNumber.status == "sold")
-        ).scalar_one()
+    total_raffles = db.execute(select(func.count()).select_from(Raffle)).scalar_one()
+    active_raffles = db.execute(
+        select(func.count()).select_from(Raffle).where(Raffle.status == "active")
+    ).scalar_one()
+    completed_raffles = db.execute(
+        select(func.count()).select_from(Raffle).where(Raffle.status == "completed")
+    ).scalar_one()
+    total_purchases = db.execute(select(func.count()).select_from(Purchase)).scalar_one()
+    total_revenue = db.execute(select(func.coalesce(func.sum(Purchase.total_amount), 0.0))).scalar_one()
+    total_numbers_sold = db.execute(
+        select(func.count()).select_from(RaffleNumber).where(RaffleNumber.status == "sold")
+    ).scalar_one()
     return {
         "total_raffles": total_raffles,
         "active_raffles": active_raffles,
@@ -584,6 +671,33 @@ async def get_admin_stats():
         "total_numbers_sold": total_numbers_sold
     }
 
+
+@app.get("/api/admin/analytics")
+def get_sales_analytics(
+    granularity: Granularity = Granularity.hour,
+    raffle_id: Optional[str] = None,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    db: Session = Depends(get_read_db),
+):
+    """Vendas, receita e numeros vendidos por minuto, hora ou dia (UTC)"""
+    # Os timestamps são gravados em UTC sem timezone
+    if start and start.tzinfo:
+        start = start.astimezone(timezone.utc).replace(tzinfo=None)
+    if end and end.tzinfo:
+        end = end.astimezone(timezone.utc).replace(tzinfo=None)
+    end = end or datetime.utcnow()
+    start = start or end - DEFAULT_WINDOWS[granularity]
+    if start >= end:
+        raise HTTPException(status_code=400, detail="start deve ser anterior a end")
+    return {
+        "granularity": granularity,
+        "raffle_id": raffle_id,
+        "start": start.isoformat(),
+        "end": end.isoformat(),
+        "buckets": query_sales(db, granularity, start, end, raffle_id),
+    }
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
@@ -1,5 +1,5 @@
 from datetime import datetime
-from sqlalchemy import Column, String, Float, Integer, DateTime, ForeignKey, UniqueConstraint
+from sqlalchemy import Column, String, Float, Integer, DateTime, ForeignKey, UniqueConstraint, Index
 from sqlalchemy.orm import relationship, Mapped, mapped_column
 from .database import Base
 
@@ -73,4 +73,17 @@ class User(Base):
     created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, nullable=False)
 
 
-
+class SalesRollup(Base):
+    __tablename__ = "sales_rollups"
+    __table_args__ = (
+        UniqueConstraint("granularity", "raffle_id", "bucket_start", name="uix_sales_rollup_bucket"),
+        Index("ix_sales_rollup_granularity_bucket", "granularity", "bucket_start"),
+    )
+    # Vendas agregadas por rifa e janela de tempo (minute, hour, day), atualizadas a cada compra
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    granularity: Mapped[str] = mapped_column(String, nullable=False)
+    raffle_id: Mapped[str] = mapped_column(String, nullable=False)
+    bucket_start: Mapped[datetime] = mapped_column(DateTime, nullable=False)
+    purchases: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    numbers_sold: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    revenue: Mapped[float] = mapped_column(Float, nullable=False, default=0.0)
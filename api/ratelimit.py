@@ -0,0 +1,98 @@
+"""
+Limite de requisições para as rotas mais acessadas.
+
+Cada cliente (usuário do token Bearer ou, sem token, o IP resolvido por
+client_ip) tem um token bucket por classe de rota. Os buckets ficam num LRU
+limitado, então a memória não cresce com IPs forjados. O webhook do Stripe,
+autenticado por WEBHOOK_SECRET, não é limitado. O limite global de
+concorrência no banco fica em database.db_admission.
+"""
+
+import math
+import os
+import time
+from collections import OrderedDict
+from fastapi import HTTPException, Request
+from .security import caller_key, is_webhook_caller
+
+def _budget(route_class: str, default: str) -> tuple[float, float]:
+    # RATE_LIMIT_<CLASSE>="rajada,tokens_por_segundo", ex.: RATE_LIMIT_PURCHASE="5,0.5"
+    raw = os.getenv(f"RATE_LIMIT_{route_class.upper()}", default)
+    burst, _, rate = raw.partition(",")
+    return float(burst), float(rate)
+
+
+# classe de rota -> (rajada máxima, tokens por segundo)
+ROUTE_BUDGETS = {
+    "purchase": _budget("purchase", "5,0.5"),
+    "grid": _budget("grid", "20,2"),
+    "read": _budget("read", "60,10"),
+}
+RATE_LIMIT_MAX_CLIENTS = int(os.getenv("RATE_LIMIT_MAX_CLIENTS", "10000"))
+
+
+class TokenBucket:
+    __slots__ = ("tokens", "updated_at")
+
+    def __init__(self, capacity: float, now: float):
+        self.tokens = capacity
+        self.updated_at = now
+
+    def take(self, capacity: float, rate: float, now: float) -> float:
+        """Consome um token. Retorna 0 se permitido, senão os segundos até haver um token."""
+        self.tokens = min(capacity, self.tokens + (now - self.updated_at) * rate)
+        self.updated_at = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / rate
+
+
+class RateLimiter:
+    def __init__(self, budgets: dict[str, tuple[float, float]], max_clients: int):
+        self.budgets = budgets
+        self.max_clients = max_clients
+        self._buckets: "OrderedDict[tuple[str, str], TokenBucket]" = OrderedDict()
+
+    def hit(self, route_class: str, client: str) -> float:
+        capacity, rate = self.budgets[route_class]
+        now = time.monotonic()
+        key = (route_class, client)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = TokenBucket(capacity, now)
+            self._buckets[key] = bucket
+            # Descarta o cliente menos recente; um bucket novo começa cheio, então
+            # perder um bucket ocioso não dá mais crédito do que ele já teria
+            if len(self._buckets) > self.max_clients:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+        return bucket.take(capacity, rate, now)
+
+
+rate_limiter = RateLimiter(ROUTE_BUDGETS, RATE_LIMIT_MAX_CLIENTS)
+
+
+def enforce_rate_limit(route_class: str, request: Request) -> None:
+    """Consome um token do cliente; responde 429 com Retry-After quando o orçamento acaba."""
+    if is_webhook_caller(request):
+        return
+    retry_after = rate_limiter.hit(route_class, caller_key(request))
+    if retry_after > 0:
+        raise HTTPException(
+            status_code=429,
+            detail="Muitas requisicoes, tente novamente em instantes",
+            headers={"Retry-After": str(math.ceil(retry_after))},
+        )
+
+
+def rate_limit(route_class: str):
+    """Dependência que aplica enforce_rate_limit à classe de rota."""
+    if route_class not in ROUTE_BUDGETS:
+        raise ValueError(f"classe de rota desconhecida: {route_class}")
+
+    async def dependency(request: Request) -> None:
+        enforce_rate_limit(route_class, request)
+
+    return dependency
@@ -1,7 +1,8 @@
+import hmac
 import os
 from datetime import datetime, timedelta, timezone
 from typing import Optional
-from fastapi import HTTPException, status, Depends
+from fastapi import HTTPException, Request, status, Depends
 from fastapi.security import OAuth2PasswordBearer
 from jose import JWTError, jwt
 from passlib.context import CryptContext
@@ -17,6 +18,12 @@ SECRET_KEY = os.getenv("SECRET_KEY", "dev-secret-change-me")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", "60"))
 
+# Quantidade de proxies confiáveis na frente da API (ex.: 1 no Render). Com N > 0,
+# o IP do cliente é o N-ésimo item a partir do fim do X-Forwarded-For
+TRUSTED_PROXY_HOPS = int(os.getenv("TRUSTED_PROXY_HOPS", "0"))
+# Segredo compartilhado com o webhook do Stripe, enviado no header X-Webhook-Secret
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+
 def hash_password(password: str) -> str:
     return pwd_context.hash(password)
 
@@ -29,6 +36,46 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None) -
     to_encode.update({"exp": expire})
     return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
 
+def decode_token_subject(token: str) -> Optional[str]:
+    """Retorna o "sub" de um token válido, sem consultar o banco."""
+    try:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    except JWTError:
+        return None
+    return payload.get("sub")
+
+def client_ip(request: Request) -> str:
+    host = request.client.host if request.client else "unknown"
+    if TRUSTED_PROXY_HOPS <= 0:
+        return host
+    forwarded = [h.strip() for h in request.headers.get("X-Forwarded-For", "").split(",") if h.strip()]
+    if len(forwarded) < TRUSTED_PROXY_HOPS:
+        return host
+    # Itens à esquerda vêm do próprio cliente e podem ser forjados
+    return forwarded[-TRUSTED_PROXY_HOPS]
+
+def is_webhook_caller(request: Request) -> bool:
+    provided = request.headers.get("X-Webhook-Secret")
+    if not WEBHOOK_SECRET or not provided:
+        return False
+    return hmac.compare_digest(provided.encode("utf-8"), WEBHOOK_SECRET.encode("utf-8"))
+
+def request_user_id(request: Request) -> Optional[str]:
+    """Usuário do token Bearer da requisição, se houver um válido."""
+    scheme, _, token = request.headers.get("Authorization", "").partition(" ")
+    if scheme.lower() == "bearer" and token:
+        return decode_token_subject(token)
+    return None
+
+def caller_key(request: Request) -> str:
+    """Identifica quem chama: o webhook, o usuário do token Bearer ou o IP do cliente."""
+    if is_webhook_caller(request):
+        return "webhook"
+    user_id = request_user_id(request)
+    if user_id:
+        return f"user:{user_id}"
+    return f"ip:{client_ip(request)}"
+
 def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)) -> User:
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
@@ -0,0 +1,64 @@
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+import pytest
+
+# Banco temporário, com uma conexão SQLite somente leitura no papel de réplica.
+# As variáveis precisam existir antes de importar api.database.
+_tmp = Path(tempfile.mkdtemp(prefix="rifa-tests-"))
+os.environ["DATABASE_URL"] = f"sqlite:///{_tmp / 'rifa.db'}"
+os.environ["DATABASE_READ_URL"] = f"sqlite:///file:{_tmp / 'rifa.db'}?mode=ro&uri=true"
+os.chdir(_tmp)  # api.main cria ./uploads
+sys.path.insert(0, str(Path(__file__).resolve().parents[2]))
+
+from fastapi.testclient import TestClient  # noqa: E402
+
+from api import database  # noqa: E402
+from api.idempotency import idempotency_store  # noqa: E402
+from api.main import app  # noqa: E402
+from api.ratelimit import rate_limiter  # noqa: E402
+
+
+@pytest.fixture
+def client():
+    idempotency_store._entries.clear()
+    rate_limiter._buckets.clear()
+    with TestClient(app) as c:
+        yield c
+
+
+@pytest.fixture
+def raffle(client):
+    payload = {
+        "title": "Rifa teste",
+        "description": "d",
+        "prize": "p",
+        "price": 2.5,
+        "total_numbers": 100,
+        "draw_date": "2030-01-01",
+    }
+    return client.post("/api/raffles", json=payload).json()
+
+
+@pytest.fixture
+def purchase_body(raffle):
+    def build(numbers):
+        return {
+            "raffle_id": raffle["id"],
+            "numbers": numbers,
+            "buyer_name": "Ana",
+            "buyer_phone": "11999999999",
+            "buyer_email": "ana@example.com",
+        }
+
+    return build
+
+
+@pytest.fixture
+def db_limit(monkeypatch):
+    def set_limit(value):
+        monkeypatch.setattr(database, "DB_CONCURRENCY_LIMIT", value)
+
+    return set_limit
@@ -0,0 +1,30 @@
+from api import database
+
+
+def _spy_sessions(monkeypatch):
+    used = []
+    primary, replica = database.SessionLocal, database.ReadSessionLocal
+    monkeypatch.setattr(database, "SessionLocal", lambda: used.append("primary") or primary())
+    monkeypatch.setattr(database, "ReadSessionLocal", lambda: used.append("replica") or replica())
+    return used
+
+
+def test_read_with_token_after_purchase_uses_primary(client, raffle, purchase_body, monkeypatch):
+    purchase = client.post("/api/purchase", json=purchase_body([1]))
+    token = purchase.headers[database.READ_YOUR_WRITES_HEADER]
+    used = _spy_sessions(monkeypatch)
+
+    url = f"/api/raffles/{raffle['id']}/numbers"
+    numbers = client.get(url, headers={database.READ_YOUR_WRITES_HEADER: token})
+    assert [n["number"] for n in numbers.json()] == [1]
+    client.get(url)
+    client.get(url, headers={database.READ_YOUR_WRITES_HEADER: "9999999999.forged"})
+
+    assert used == ["primary", "replica", "replica"]
+
+
+def test_failed_purchase_returns_no_token(client, purchase_body):
+    failed = client.post("/api/purchase", json={**purchase_body([1]), "raffle_id": "missing"})
+    assert failed.status_code == 404
+    assert database.READ_YOUR_WRITES_HEADER not in failed.headers
+    assert not failed.cookies
@@ -0,0 +1,125 @@
+import asyncio
+import time
+
+import pytest
+from fastapi import HTTPException, Response
+from starlette.requests import Request
+
+from api import main
+from api.idempotency import IdempotencyStore, idempotency_store
+from api.ratelimit import rate_limiter
+
+
+def test_concurrent_duplicate_waits_for_in_flight_request():
+    store = IdempotencyStore()
+
+    async def scenario():
+        assert await store.begin("anonymous", "k", "f") is None
+        waiter = asyncio.create_task(store.begin("anonymous", "k", "f"))
+        await asyncio.sleep(0.01)
+        assert not waiter.done()
+        store.complete("anonymous", "k", 200, {"id": "p1"})
+        return await waiter
+
+    stored = asyncio.run(scenario())
+    assert stored.status_code == 200
+    assert stored.body == {"id": "p1"}
+
+
+def test_duplicate_wait_times_out_with_409():
+    store = IdempotencyStore(wait_seconds=0.01)
+
+    async def scenario():
+        assert await store.begin("anonymous", "k", "f") is None
+        await store.begin("anonymous", "k", "f")
+
+    with pytest.raises(HTTPException) as exc:
+        asyncio.run(scenario())
+    assert exc.value.status_code == 409
+    assert exc.value.headers["Retry-After"] == "1"
+
+
+def test_payload_mismatch_returns_422():
+    store = IdempotencyStore()
+
+    async def scenario():
+        await store.begin("anonymous", "k", "f1")
+        store.complete("anonymous", "k", 200, {})
+        await store.begin("anonymous", "k", "f2")
+
+    with pytest.raises(HTTPException) as exc:
+        asyncio.run(scenario())
+    assert exc.value.status_code == 422
+
+
+def test_eviction_keeps_in_flight_keys():
+    store = IdempotencyStore(max_entries=3)
+
+    async def scenario():
+        await store.begin("anonymous", "in-flight", "f")
+        for i in range(10):
+            await store.begin("anonymous", f"k{i}", "f")
+            store.complete("anonymous", f"k{i}", 200, {"i": i})
+
+    asyncio.run(scenario())
+    assert list(store._entries) == [("anonymous", "in-flight"), ("anonymous", "k8"), ("anonymous", "k9")]
+
+
+def test_replay_returns_original_response(client, purchase_body):
+    headers = {"Idempotency-Key": "replay"}
+    first = client.post("/api/purchase", json=purchase_body([1, 2]), headers=headers)
+    second = client.post("/api/purchase", json=purchase_body([1, 2]), headers=headers)
+    assert first.status_code == 200
+    assert second.status_code == 200
+    assert second.headers["Idempotent-Replayed"] == "true"
+    assert second.json()["id"] == first.json()["id"]
+
+
+def test_client_error_is_replayed(client, purchase_body):
+    body = {**purchase_body([1]), "raffle_id": "missing"}
+    headers = {"Idempotency-Key": "not-found"}
+    assert client.post("/api/purchase", json=body, headers=headers).status_code == 404
+    replay = client.post("/api/purchase", json=body, headers=headers)
+    assert replay.status_code == 404
+    assert replay.headers["Idempotent-Replayed"] == "true"
+
+
+def test_key_released_after_429(client, purchase_body, monkeypatch):
+    monkeypatch.setitem(rate_limiter.budgets, "purchase", (1, 0.001))
+    assert client.post("/api/purchase", json=purchase_body([1])).status_code == 200
+    headers = {"Idempotency-Key": "limited"}
+    limited = client.post("/api/purchase", json=purchase_body([2]), headers=headers)
+    assert limited.status_code == 429
+    assert not idempotency_store._entries
+    rate_limiter._buckets.clear()
+    assert client.post("/api/purchase", json=purchase_body([2]), headers=headers).status_code == 200
+
+
+def test_key_released_after_503(client, purchase_body, db_limit):
+    headers = {"Idempotency-Key": "overloaded"}
+    db_limit(0)
+    assert client.post("/api/purchase", json=purchase_body([1]), headers=headers).status_code == 503
+    assert not idempotency_store._entries
+    db_limit(15)
+    assert client.post("/api/purchase", json=purchase_body([1]), headers=headers).status_code == 200
+
+
+def test_key_released_when_request_is_cancelled(client, purchase_body, monkeypatch):
+    def slow_purchase(purchase):
+        time.sleep(0.1)
+        return {}
+
+    monkeypatch.setattr(main, "_create_purchase_in_session", slow_purchase)
+    request = Request({"type": "http", "headers": [], "client": ("10.0.0.1", 1234)})
+
+    async def scenario():
+        task = asyncio.create_task(
+            main.create_purchase(main.PurchaseCreate(**purchase_body([1])), request, Response(), "cancelled")
+        )
+        await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(scenario())
+    assert not idempotency_store._entries
@@ -0,0 +1,19 @@
+from api.ratelimit import ROUTE_BUDGETS
+
+
+def test_rate_limit_returns_429_with_retry_after(client, raffle):
+    burst, _ = ROUTE_BUDGETS["grid"]
+    url = f"/api/raffles/{raffle['id']}/numbers"
+    for _ in range(int(burst)):
+        assert client.get(url).status_code == 200
+    limited = client.get(url)
+    assert limited.status_code == 429
+    assert int(limited.headers["Retry-After"]) >= 1
+
+
+def test_db_concurrency_cap_returns_503_with_retry_after(client, db_limit):
+    db_limit(0)
+    for url in ("/api/raffles", "/api/purchases", "/api/admin/stats"):
+        overloaded = client.get(url)
+        assert overloaded.status_code == 503
+        assert overloaded.headers["Retry-After"] == "1"